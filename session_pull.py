@@ -1,18 +1,65 @@
 import sys
-import math
 import os
 import time
-import json
+import threading
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime, timedelta, timezone
 
-import requests
+import numpy as np
+import orjson
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from requests_cache import CachedSession
+from urllib3.util.retry import Retry
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 
 
 BASE = "https://aircasting.org"
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+#nominatim policy wants an identifying user agent with a way to contact us
+USER_AGENT = "aircasting-client/1.0 (https://github.com/emmab0118/aircasting)"
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "aircasting")
+INV_R_EARTH_KM = 1 / 6371 #1 / earth radius in km
+SESSIONS_TTL = 3600 #seconds, session lists and stream metadata change slowly
+MEASUREMENTS_TTL = 300 #seconds, measurements are fresher
+GEOCODE_TTL = 7 * 24 * 3600 #seconds, cities dont move
+
+#common alternate keys for a measurement's time and value, in order of preference
+TIME_KEYS = ["time", "measured_at", "timestamp", "recorded_at", "created_at"]
+VALUE_KEYS = [
+    "value",
+    "value_calibrated",
+    "value_ugm3",
+    "value_rounded",
+    "measurement_value",
+]
+
+NOMINATIM_MIN_INTERVAL = 1.1 #seconds between nominatim calls, policy is max 1 req/s
+_last_nominatim_call = 0.0 #monotonic time of the last nominatim request
+_nominatim_lock = threading.Lock()
+
+#one shared session so repeat calls to the same host reuse the tcp/tls connection
+#it's also a sqlite backed http cache, so repeat runs skip the network entirely
+SESSION = CachedSession(
+    os.path.join(CACHE_DIR, "http_cache"),
+    backend="sqlite",
+    expire_after=SESSIONS_TTL,
+    urls_expire_after={
+        "nominatim.openstreetmap.org": GEOCODE_TTL,
+        "aircasting.org/api/v3/fixed_measurements": MEASUREMENTS_TTL,
+    },
+)
+SESSION.headers.update({"User-Agent": USER_AGENT})
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+    ),
+)
 
 
 #helper funcs for converting between datetime and epoch
@@ -28,16 +75,36 @@ def to_epoch_s(dt: datetime) -> int:
     return int(dt.timestamp()) #same as other one but epoch s
 
 
+def floor_dt(dt: datetime, seconds: int) -> datetime:
+    #round down to a multiple of seconds so repeat queries within a cache ttl share a key
+    return datetime.fromtimestamp(to_epoch_s(dt) // seconds * seconds, timezone.utc)
+
+
 def encode_q(obj: dict) -> str:
-    return urllib.parse.quote(json.dumps(obj), safe="") #takes py dict convert to json string
+    return urllib.parse.quote(orjson.dumps(obj).decode(), safe="") #takes py dict convert to json string
 #need for aircasting's mapstyle endpoints
 
 
-#geocoding city --> lat,lon
-def geocode_city(city: str) -> tuple[float, float] | None:
-    url = "https://nominatim.openstreetmap.org/search"
-    params = {"q": city, "format": "json", "limit": 1}
-    r = requests.get(url, params=params, headers={"User-Agent": "aircasting-client"}, timeout=15)
+def _nominatim_wait():
+    #throttle, blocks until NOMINATIM_MIN_INTERVAL has passed since the last call
+    #so geocoding lots of cities in a row doesnt get the ip blocked
+    global _last_nominatim_call
+    with _nominatim_lock:
+        wait = NOMINATIM_MIN_INTERVAL - (time.monotonic() - _last_nominatim_call)
+        if wait > 0:
+            time.sleep(wait)
+        _last_nominatim_call = time.monotonic()
+
+
+@lru_cache(maxsize=256)
+def _geocode(query: str) -> tuple[float, float] | None:
+    params = {"q": query, "format": "json", "limit": 1}
+    headers = {"User-Agent": USER_AGENT}
+    #cities looked up before come from the http cache, only real requests need the throttle
+    r = SESSION.get(NOMINATIM_URL, params=params, headers=headers, timeout=15, only_if_cached=True)
+    if r.status_code == 504: #not in the cache
+        _nominatim_wait()
+        r = SESSION.get(NOMINATIM_URL, params=params, headers=headers, timeout=15)
     r.raise_for_status()
     data = r.json()
     if not data:
@@ -46,24 +113,22 @@ def geocode_city(city: str) -> tuple[float, float] | None:
     return lat, lon
 
 
-def calculate_bounding_box(lat: float, lon: float, radius_km: float = 50) -> tuple:
+#geocoding city --> lat,lon
+def geocode_city(city: str) -> tuple[float, float] | None:
+    #normalize so "Chicago " and "chicago" share one cache entry
+    return _geocode(city.strip().lower())
+
+
+def calculate_bounding_box(lat, lon, radius_km: float = 50) -> tuple:
     #calculate bounding box around coordinates
-    #earth radius in km
-    R = 6371
-    # convert latitude and longitude to rads
-    lat_rad = math.radians(lat)
-    lon_rad = math.radians(lon)
-    
-    #calculate deltas
-    delta_lat = radius_km / R
-    delta_lon = radius_km / (R * math.cos(lat_rad))
-    
-    # Convert back to degrees
-    north = math.degrees(lat_rad + delta_lat)
-    south = math.degrees(lat_rad - delta_lat)
-    east = math.degrees(lon_rad + delta_lon)
-    west = math.degrees(lon_rad - delta_lon)
-    
+    #works on plain floats or numpy arrays of many points at once
+    #deltas in rads (arc length / earth radius) converted back to degrees
+    delta_lat = np.rad2deg(radius_km * INV_R_EARTH_KM)
+    delta_lon = np.rad2deg(radius_km * INV_R_EARTH_KM / np.cos(np.deg2rad(lat)))
+    west, east = lon - delta_lon, lon + delta_lon
+    south, north = lat - delta_lat, lat + delta_lat
+    if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+        return float(west), float(east), float(south), float(north)
     return west, east, south, north
 
 
@@ -81,22 +146,15 @@ def list_sessions_v3(start_iso: str = None, end_iso: str = None, bbox: tuple = N
         params["north"] = bbox[3]
     
     print(f"Searching with bbox: {bbox}")
-    r = requests.get(f"{BASE}/api/v3/sessions", params=params, timeout=30)
+    r = SESSION.get(f"{BASE}/api/v3/sessions", params=params, timeout=30)
     r.raise_for_status()
-    return r.json().get("sessions", []) #return list of sessions
+    return orjson.loads(r.content).get("sessions", []) #return list of sessions
 
 
 def pick_fixed_session_v3(bbox: tuple = None) -> dict | None:
-    #try default window (last 30 days)
-    sessions = list_sessions_v3(bbox=bbox)
-    fixed = next((s for s in sessions if s.get("type") == "FixedSession"), None)
-    if fixed:
-        return fixed
-    if sessions:
-        return sessions[0]
-
-    #nothing comes back, try looser range (last 365 days)
-    end = utc_now()
+    #ask for the last 365 days straight away, the server default (last 30 days)
+    #is a subset of it so a separate first call only costs a round trip
+    end = floor_dt(utc_now(), SESSIONS_TTL)
     start = end - timedelta(days=365)
     sessions = list_sessions_v3(
         start_iso=start.strftime("%Y-%m-%dT%H:%M:%SZ"),
@@ -109,47 +167,75 @@ def pick_fixed_session_v3(bbox: tuple = None) -> dict | None:
     return sessions[0] if sessions else None
 
 
+def fetch_mapstyle_sessions(kind: str, q: dict) -> list:
+    #one mapstyle query for a session kind, q holds the bbox/time/sensor filters
+    url = f"{BASE}/api/fixed/{kind}/sessions.json?q={encode_q(q)}"
+    r = SESSION.get(url, timeout=30)
+    r.raise_for_status()
+    return orjson.loads(r.content).get("sessions", [])
+
+
 def pick_fixed_session_mapstyle(bbox: tuple = None) -> dict | None:
     #try mapstyle endpoints if /v3/sessions didnt work
-    #try diff sensor names or time windows or session kinds stored in vars
+    #try diff sensor names or session kinds stored in vars
+    #only the widest time window, the 7/30 day ones are subsets of it
+    #server needs a sensor_name so thats still one query per sensor
     sensor_names = ["AirBeam3-PM2.5", "AirBeam2-PM2.5", "AirBeam-PM2.5"]
-    day_windows = [7, 30, 90]  # days
+    days = 90
     kinds = ["active", "dormant"]
 
-    for kind in kinds:
-        for days in day_windows:
-            for sensor in sensor_names:
-                now = utc_now()
-                q = {
-                    "time_from": to_epoch_s(now - timedelta(days=days)),
-                    "time_to": to_epoch_s(now),
-                    "tags": "",
-                    "usernames": "",
-                    "west": bbox[0] if bbox else -125.00001,
-                    "east": bbox[1] if bbox else -66.93457,
-                    "south": bbox[2] if bbox else 24.396308,
-                    "north": bbox[3] if bbox else 49.3457868,
-                    "sensor_name": sensor,
-                    "measurement_type": "Particulate Matter",
-                    "unit_symbol": "µg/m³",
-                }
-                url = f"{BASE}/api/fixed/{kind}/sessions.json?q={encode_q(q)}"
-                r = requests.get(url, timeout=30)
-                r.raise_for_status()
-                sessions = r.json().get("sessions", [])
-                if sessions:
-                    # Normalize to dict with id
-                    s0 = sessions[0]
-                    sid = (
-                        s0["id"]
-                        if isinstance(s0, dict) and "id" in s0
-                        else (s0.get("session_id") if isinstance(s0, dict) else s0)
-                    )
-                    return {
-                        "id": sid,
-                        "picked_via": f"mapstyle:{kind}:{days}d:{sensor}",
-                    }
-    return None
+    #everything except sensor_name is the same for every query
+    now = floor_dt(utc_now(), SESSIONS_TTL)
+    base = {
+        "time_from": to_epoch_s(now - timedelta(days=days)),
+        "time_to": to_epoch_s(now),
+        "tags": "",
+        "usernames": "",
+        "west": bbox[0] if bbox else -125.00001,
+        "east": bbox[1] if bbox else -66.93457,
+        "south": bbox[2] if bbox else 24.396308,
+        "north": bbox[3] if bbox else 49.3457868,
+        "measurement_type": "Particulate Matter",
+        "unit_symbol": "µg/m³",
+    }
+
+    #queries are independent so send them all at once, but read the results
+    #in list order (= preference order) so the pick doesnt depend on timing
+    combos = [(kind, sensor) for kind in kinds for sensor in sensor_names]
+    found = None
+    executor = ThreadPoolExecutor(max_workers=len(combos))
+    try:
+        futures = [
+            executor.submit(fetch_mapstyle_sessions, kind, {**base, "sensor_name": sensor})
+            for kind, sensor in combos
+        ]
+        for (kind, sensor), fut in zip(combos, futures):
+            try:
+                sessions = fut.result()
+            except (RequestException, ValueError) as e:
+                #one failed query shouldnt sink the others, treat it as empty
+                print(f"mapstyle:{kind}:{sensor} query failed: {e}")
+                continue
+            if sessions:
+                found = (kind, sensor, sessions)
+                break
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if not found:
+        return None
+    kind, sensor, sessions = found
+    # Normalize to dict with id
+    s0 = sessions[0]
+    sid = (
+        s0["id"]
+        if isinstance(s0, dict) and "id" in s0
+        else (s0.get("session_id") if isinstance(s0, dict) else s0)
+    )
+    return {
+        "id": sid,
+        "picked_via": f"mapstyle:{kind}:{days}d:{sensor}",
+    }
 
 
 
@@ -157,88 +243,97 @@ def pick_fixed_session_mapstyle(bbox: tuple = None) -> dict | None:
 
 def get_streams(session_id: int) -> list:
     #retrieve streams (types of data recorded) for a session like PM2.5 or temp or humidity and stuff
-    r = requests.get(
+    r = SESSION.get(
         f"{BASE}/api/fixed/sessions/{session_id}/streams.json",
         params={"measurements_limit": 1},
         timeout=30,
     )
     r.raise_for_status()
-    return r.json().get("streams", [])
+    return orjson.loads(r.content).get("streams", [])
 
 
 
 def find_stream_with_data(
-    #loop thru streams, try diff lookback windows until find one w data
+    #one request per stream for the whole lookback (it covers every shorter window)
+    #streams are probed one at a time in order so no year long pull is wasted,
+    #a stream w/o data comes back empty and cheap, first one w data wins
     #return stream_id, metadata, measurements
-    streams: list, lookbacks_h: list
+    streams: list, lookback_h: int
 ) -> tuple[int | None, dict | None, list]:
+    #same end time for every probe, computed once instead of per stream
+    end_ms = to_epoch_ms(floor_dt(utc_now(), MEASUREMENTS_TTL))
     for s in streams:
         sid = s.get("stream_id")
-        for h in lookbacks_h:
-            ms, url = get_fixed_measurements(sid, h, return_url=True)
-            print(
-                f"Probe stream {sid} {s.get('sensor_name','')} | last {h}h -> {len(ms)} points"
-            )
-            if ms:
-                print("Using window:", h, "hours")
-                return sid, s, ms
+        ms = get_fixed_measurements(sid, lookback_h, end_ms)
+        print(
+            f"Probe stream {sid} {s.get('sensor_name','')} | last {lookback_h}h -> {len(ms)} points"
+        )
+        if ms:
+            return sid, s, ms
     return None, None, []
 
 
 
-def get_fixed_measurements(stream_id: int, hours: int = 24, return_url: bool = False):
-    #fetch the actual measurements for given stream
-    end_ms = int(time.time() * 1000)
+def get_fixed_measurements(stream_id: int, hours: int = 24, end_ms: int = None) -> list:
+    #fetch the actual measurements for given stream, window ends at end_ms (default now)
+    #body is buffered by the http cache anyway, so orjson it in one go
+    #and only keep the time/value keys coerce_df looks at
+    if end_ms is None:
+        end_ms = to_epoch_ms(floor_dt(utc_now(), MEASUREMENTS_TTL))
     start_ms = end_ms - hours * 3600 * 1000
-    r = requests.get(
+    r = SESSION.get(
         f"{BASE}/api/v3/fixed_measurements",
         params={"stream_id": stream_id, "start_time": start_ms, "end_time": end_ms},
         timeout=60,
     )
     r.raise_for_status()
-    return (r.json(), r.url) if return_url else r.json()
+    keep = TIME_KEYS + VALUE_KEYS
+    return [
+        {k: m[k] for k in keep if k in m}
+        for m in orjson.loads(r.content)
+    ]
 
 
 
 #schema normalization funcs  so we can use pandas later
-def to_datetime_any(x):
-    if pd.isna(x):
-        return pd.NaT
-    if isinstance(x, (int, float)):
-        x = int(x)
-        # 10 digits -> seconds, 13 digits -> ms (heuristic)
-        return pd.to_datetime(x, unit="ms" if x > 10_000_000_000 else "s", utc=True)
-    # Try ISO strings
-    return pd.to_datetime(x, utc=True, errors="coerce")
+def to_datetime_col(s: pd.Series) -> pd.Series:
+    #convert a whole column at once instead of one pd.to_datetime call per row
+    #numbers are epochs, anything else is tried as an ISO string, so at most 3 calls
+    num = s if pd.api.types.is_numeric_dtype(s) else pd.to_numeric(s, errors="coerce")
+    out = pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns, UTC]")
+    # 10 digits -> seconds, 13 digits -> ms (heuristic)
+    is_ms = num > 10_000_000_000
+    is_s = num.notna() & ~is_ms
+    out[is_ms] = pd.to_datetime(num[is_ms], unit="ms", utc=True)
+    out[is_s] = pd.to_datetime(num[is_s], unit="s", utc=True)
+    is_str = num.isna() & s.notna()
+    if is_str.any():
+        out[is_str] = pd.to_datetime(s[is_str], utc=True, errors="coerce", format="ISO8601")
+    return out
+
+
+def first_present(df: pd.DataFrame, keys: list) -> pd.Series:
+    #per row, take the first non-null value among the key columns that exist
+    present = [k for k in keys if k in df.columns]
+    if not present:
+        return pd.Series(None, index=df.index, dtype=object)
+    return df[present].bfill(axis=1).iloc[:, 0]
 
 
 def coerce_df(measurements: list) -> pd.DataFrame:
-    #map common alternate keys to time/value, but keep all columns
+    #map common alternate keys to time/value
+    #only those two typed columns are kept (datetime + float64), not a mixed object frame
     if not measurements:
-        return pd.DataFrame()
-
-    time_keys = ["time", "measured_at", "timestamp", "recorded_at", "created_at"]
-    value_keys = [
-        "value",
-        "value_calibrated",
-        "value_ugm3",
-        "value_rounded",
-        "measurement_value",
-    ]
-
-    rows = []
-    for m in measurements:
-        t = next((m[k] for k in time_keys if k in m), None)
-        v = next((m[k] for k in value_keys if k in m), None)
-        row = {"time": t, "value": v}
-        row.update(m)
-        rows.append(row)
-
-    df = pd.DataFrame(rows)
-    if "time" in df.columns:
-        df["time"] = df["time"].apply(to_datetime_any)
-    return df
+        return pd.DataFrame({
+            "time": pd.Series(dtype="datetime64[ns, UTC]"),
+            "value": pd.Series(dtype="float64"),
+        })
 
+    raw = pd.DataFrame.from_records(measurements)
+    return pd.DataFrame({
+        "time": to_datetime_col(first_present(raw, TIME_KEYS)),
+        "value": pd.to_numeric(first_present(raw, VALUE_KEYS), errors="coerce").astype("float64"),
+    })
 
 
 
@@ -281,18 +376,15 @@ def main():
         print("No streams found for this session.")
         sys.exit(1)
 
-    #prefer PM2.5 streams first in the order
-    streams_sorted = sorted(
-        streams,
-        key=lambda s: (
-            0 if "PM2.5" in (s.get("sensor_name") or "") else 1,
-            s.get("sensor_name", ""),
-        ),
-    )
+    #prefer PM2.5 streams first in the order, one pass split instead of a full sort
+    pm25, rest = [], []
+    for s in streams:
+        (pm25 if "PM2.5" in (s.get("sensor_name") or "") else rest).append(s)
+    streams_sorted = pm25 + rest
 
-    LOOKBACKS_H = [24, 7 * 24, 30 * 24, 90 * 24, 180 * 24, 365 * 24]
+    LOOKBACK_H = 365 * 24
     stream_id, stream_meta, measurements = find_stream_with_data(
-        streams_sorted, LOOKBACKS_H
+        streams_sorted, LOOKBACK_H
     )
 
     if not measurements:
@@ -305,16 +397,31 @@ def main():
     print("Items returned:", len(measurements))
 
     #normalize and save
-    df = coerce_df(measurements).dropna(subset=["time"])
-    df = df.sort_values("time")
+    #api returns mostly sorted data so stable mergesort is ~linear, repeated timestamps keep the last reading
+    df = (
+        coerce_df(measurements)
+        .dropna(subset=["time"])
+        .sort_values("time", kind="mergesort")
+        .drop_duplicates(subset="time", keep="last")
+    )
     out_csv = f"session{session_id}-stream{stream_id}.csv"
     df.to_csv(out_csv, index=False)
     print("Saved:", out_csv, "| rows:", len(df))
 
 
-    if not df.empty and "value" in df.columns:
+    if os.environ.get("AIRCASTING_NO_PLOT") == "1": #headless/batch runs
+        print("AIRCASTING_NO_PLOT=1, skipping plot.")
+    elif not df.empty and "value" in df.columns:
+        #matplotlib is slow to import, only load it when theres something to plot
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots(figsize=(10, 4))
-        sns.lineplot(data=df, x="time", y="value", ax=ax)
+        #plain numpy arrays straight into ax.plot, naive datetime64 (already UTC) is the fast path
+        ax.plot(
+            df["time"].dt.tz_localize(None).to_numpy(),
+            df["value"].to_numpy(),
+            linewidth=0.8,
+        )
         ax.set_xlabel("Time (UTC)")
         ax.set_ylabel(stream_meta.get("sensor_unit", "Value"))
         ax.set_title(f"{stream_meta.get('sensor_name', 'Stream')} - {city_name if city_name else 'Unknown Location'}")